@@ -0,0 +1,355 @@
+import json
+import time
+import random
+import asyncio
+import logging
+import multiprocessing
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import create_async_engine
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from . import app as flask_app
+from . import (ENV_VARS, UserEntry, UserAnswer, ChatAnswer, survey_registry, answer_buffer,
+  answer_rows, upsert_statement, answer_upserts, progress_statements, set_sqlite_pragmas,
+  participant_cache, chat_answers_payload, chat_answers_etag, chat_payloads, chat_version_statements, stamp_chat_versions,
+  participant_lock_statement, clean_answer_item, restore_participant, safe_cast, utcnow, metrics, request_logger, COUNT_BUCKETS,
+  check_participant_cache, serving_processes, setup_logging, best_encoding, encoding_etag)
+
+# ASGI serving mode - the high-frequency participant calls (/save_answer,
+# /get_chat_answers, /get_survey) are answered on the event loop with an async
+# engine (aiomysql for MySQL, aiosqlite for SQLite, ASYNC_DB_URI overrides) and
+# the survey registry's ready-made bytes. Same URLs and response shapes as the
+# Flask views, every other request goes to the Flask app through WsgiToAsgi.
+#
+#   STUDY_PARTICIPANT_CACHE_URL=redis://... uvicorn --workers 4 <package>.asgi:app
+#
+# uvicorn runs each of several workers as a multiprocessing child, the in-process
+# participant cache is switched off there unless PARTICIPANT_CACHE_URL shares it
+# and app.log is left to an external rotation, like with gunicorn.conf.py.
+# Run 'flask init-db' / 'flask migrate' first, the async path does not create tables.
+
+ASYNC_DRIVERS = {
+  'mysql': 'mysql+aiomysql',
+  'sqlite': 'sqlite+aiosqlite',
+  'postgresql': 'postgresql+asyncpg',
+}
+
+JSON_HEADERS = [(b'content-type', b'text/html; charset=utf-8'), (b'content_type', b'application/json')]
+
+# asgiref runs every WSGI call on one shared thread, the Flask views are thread-safe
+# so they run on the loop's executor instead, like in a threaded WSGI server
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+  run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False)
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+  async def __call__(self, scope, receive, send):
+    await ThreadedWsgiToAsgiInstance(self.wsgi_application)(scope, receive, send)
+
+def async_database_config(flask_app):
+  db_uri = ENV_VARS.get('ASYNC_DB_URI', '').strip()
+  if db_uri == '':
+    url = sqlalchemy.engine.make_url(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+    db_uri = url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+  # same pool sizing as the sync engine, the async pool class comes with the driver
+  engine_options = dict(flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+  engine_options.pop('poolclass', None)
+  engine_options.pop('connect_args', None)
+  if str(db_uri).startswith("sqlite"):
+    # one writer at a time anyway, waiting in the pool is fairer than SQLite's busy retries
+    engine_options['connect_args'] = {'timeout': 30}
+    engine_options['pool_size'] = int(ENV_VARS.get('ASYNC_SQLITE_POOL_SIZE', '1') or 1)
+    engine_options['max_overflow'] = 0
+  return db_uri, engine_options
+
+class Request(object):
+  def __init__(self, scope, body=b''):
+    self.scope = scope
+    self.path = scope['path']
+    self.method = scope['method']
+    self.args = first_values(scope.get('query_string', b''))
+    self.form = first_values(body)
+    self.headers = dict((name.decode('latin-1').lower(), value.decode('latin-1')) for name, value in scope.get('headers', []))
+
+  # Content codings the client takes, q=0 excluded
+  def accept_encodings(self):
+    encodings = set()
+    for part in self.headers.get('accept-encoding', '').split(','):
+      coding, _, params = part.strip().partition(';')
+      if coding != '' and params.replace(' ', '') not in ['q=0', 'q=0.0']:
+        encodings.add(coding.strip().lower())
+    return encodings
+
+  def etag_matches(self, etag):
+    if_none_match = self.headers.get('if-none-match')
+    if if_none_match == None:
+      return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or '"%s"' % etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+def first_values(query):
+  return dict((name, values[0]) for name, values in parse_qs(query.decode('utf-8'), keep_blank_values=True).items())
+
+class StudyASGI(object):
+  def __init__(self, flask_app):
+    self.flask_app = flask_app
+    self.wsgi = ThreadedWsgiToAsgi(flask_app)
+    db_uri, engine_options = async_database_config(flask_app)
+    self.engine = create_async_engine(db_uri, **engine_options)
+    self.dialect = self.engine.dialect.name
+    if self.dialect == "sqlite":
+      sqlalchemy.event.listen(self.engine.sync_engine, "connect", set_sqlite_pragmas)
+    logging.info("ASGI mode, async DB: %r", self.engine.url)
+
+    # path -> (endpoint, handler, methods)
+    self.routes = {
+      '/save_answer': ('save_answer', self.save_answer, ['GET', 'POST']),
+      '/get_chat_answers': ('get_chat_answers', self.get_chat_answers, ['GET']),
+      '/get_survey': ('get_survey', self.get_survey, ['GET']),
+    }
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      return await self.lifespan(receive, send)
+
+    route = self.routes.get(scope.get('path')) if scope['type'] == 'http' else None
+    content_type = dict(scope.get('headers', [])).get(b'content-type', b'')
+    # multipart forms and unknown methods are left to Flask
+    if route == None or scope['method'] not in route[2] or content_type.startswith(b'multipart/'):
+      return await self.wsgi(scope, receive, send)
+    # the async upsert needs the unique answer indexes, until then Flask writes the answers
+    if route[0] == 'save_answer' and not answer_upserts.ready:
+      return await self.wsgi(scope, receive, send)
+
+    endpoint, handler, methods = route
+    start = time.perf_counter()
+    body = b''
+    if scope['method'] == 'POST':
+      body = await read_body(receive)
+    request = Request(scope, body)
+    log_fields = {}
+
+    try:
+      status, headers, resp_body = await handler(request, log_fields)
+    except Exception:
+      logging.exception("Exception on %s [%s]", request.path, request.method)
+      status, headers, resp_body = 500, [(b'content-type', b'text/plain')], b'Internal Server Error'
+
+    await send({'type': 'http.response.start', 'status': status,
+      'headers': headers + [(b'content-length', str(len(resp_body)).encode('latin-1'))]})
+    await send({'type': 'http.response.body', 'body': resp_body})
+
+    self.record(request, endpoint, status, time.perf_counter() - start, log_fields)
+
+  async def lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        # threads for the Flask routes and survey loads (ASGI_WSGI_THREADS)
+        threads = max(1, int(ENV_VARS.get('ASGI_WSGI_THREADS', '32') or 32))
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi"))
+        await asyncio.get_running_loop().run_in_executor(None, self.check_upserts)
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        await self.engine.dispose()
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+  def check_upserts(self):
+    with self.flask_app.app_context():
+      answer_upserts.check()
+
+  # Same metrics and request log line as the Flask hooks
+  def record(self, request, endpoint, status, elapsed, log_fields):
+    config = self.flask_app.config
+    labels = (('endpoint', endpoint),)
+    if config['METRICS_ENABLED']:
+      metrics.observe("study_request_duration_seconds", labels, elapsed)
+      metrics.observe("study_request_db_statements", labels, log_fields.pop('db_statements', 0), COUNT_BUCKETS)
+      metrics.inc("study_requests_total", labels + (('status', status),))
+
+    if status < 500 and endpoint in config['LOG_SAMPLED_ENDPOINTS'] and random.random() >= config['LOG_SAMPLE_RATE']:
+      return
+    entry = {'method': request.method, 'path': request.path, 'endpoint': endpoint, 'status': status,
+      'duration_ms': round(elapsed * 1000.0, 2), 'asgi': True}
+    entry.update(log_fields)
+    request_logger.info("%s %s %d", request.method, request.path, status, extra={'request': entry})
+
+  async def save_answer(self, request, log_fields):
+    user_id = request.args.get('user_id')
+    source = request.args.get('source')
+    q_id = request.args.get('q_id')
+    q_ans = request.form.get('q_ans')
+    opt_id = request.form.get('opt_id')
+    # the answer text itself stays out of the logs
+    log_fields.update(user_id=user_id, source=source, q_id=q_id, answer_len=len(q_ans) if q_ans != None else None, opt_id=opt_id)
+
+    model = ChatAnswer if source == "chat" else UserAnswer
+    item, message = clean_answer_item({'source': source, 'q_id': q_id, 'q_ans': q_ans, 'opt_id': opt_id, 'timestamp': utcnow()})
+
+    if user_id == None or q_id == None or q_ans == None:
+      json_resp = json.dumps({'status': 'ERROR', 'message':'Missing arguments'})
+    elif item == None:
+      json_resp = json.dumps({'status': 'ERROR', 'message':message})
+    elif answer_buffer.enabled and not await self.buffer_room():
+      json_resp = json.dumps({'status': 'ERROR', 'message':'Too many answers waiting, try again'})
+    elif await self.save_items(model, user_id, [item], log_fields):
+      json_resp = json.dumps({'status': 'OK', 'message':'', 'q_id':q_id, 'q_ans':q_ans})
+    else:
+      json_resp = json.dumps({'status': 'ERROR', 'message':'Unknown user'})
+    return 200, JSON_HEADERS, json_resp.encode('utf-8')
+
+  # Backpressure of the write-behind buffer, a full one is waited for off the loop
+  async def buffer_room(self):
+    return answer_buffer.size < answer_buffer.max_size or \
+      await asyncio.get_running_loop().run_in_executor(None, answer_buffer.wait_for_room)
+
+  # The participant cache is in memory or a Redis round trip, the latter runs off the loop
+  async def cache_call(self, func, *args):
+    if participant_cache.store.remote:
+      return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+    return func(*args)
+
+  # Cached participant entry, like get_participant()
+  async def participant(self, conn, user_id, log_fields):
+    entry = await self.cache_call(participant_cache.get, 'entry', user_id)
+    if entry != None:
+      return entry
+
+    result = await conn.execute(sqlalchemy.select(UserEntry.condition, UserEntry.current_page)
+      .where(UserEntry.user_id == user_id))
+    row = result.first()
+    log_fields['db_statements'] = log_fields.get('db_statements', 0) + 1
+    if row != None:
+      entry = {'condition': row.condition, 'current_page': row.current_page}
+    else:
+      # archived participants come back through the Flask session
+      entry = await asyncio.get_running_loop().run_in_executor(None, self.restore, user_id)
+      if entry == None:
+        return None
+    pending = answer_buffer.pending_for(UserAnswer, user_id)
+    if "page" in pending:
+      entry['current_page'] = safe_cast(pending["page"][0]['q_ans'], int)
+    await self.cache_call(participant_cache.fill, 'entry', user_id, entry)
+    return entry
+
+  def restore(self, user_id):
+    with self.flask_app.app_context():
+      return restore_participant(user_id)
+
+  # Write path of save_answers(), False for unknown participants
+  async def save_items(self, model, user_id, items, log_fields, retry=True):
+    survey_items = items if model is UserAnswer else []
+    chat_items = items if model is ChatAnswer else []
+    locked = True
+    async with self.engine.begin() as conn:
+      if await self.participant(conn, user_id, log_fields) == None:
+        return False
+
+      if answer_buffer.enabled:
+        answer_buffer.put(model, user_id, items, True)
+      else:
+        # the participant's row first, like lock_participants()
+        locked = (await conn.execute(participant_lock_statement([user_id]))).first() != None
+        log_fields['db_statements'] = log_fields.get('db_statements', 0) + 1
+        if locked:
+          rows = answer_rows(model, user_id, items, True)
+          if model is ChatAnswer:
+            bump, read = chat_version_statements([user_id])
+            await conn.execute(bump)
+            stamp_chat_versions(rows, await conn.execute(read))
+            log_fields['db_statements'] += 2
+          await conn.execute(upsert_statement(model, True, self.dialect), rows)
+          statements = progress_statements(rows if model is UserAnswer else [], rows if model is ChatAnswer else [])
+          for stmt, params in statements:
+            await conn.execute(stmt, params)
+          log_fields['db_statements'] += 1 + len(statements)
+
+    # archived since it was cached, the retry looks it up again and restores it
+    if not locked:
+      await self.cache_call(participant_cache.invalidate, user_id)
+      return retry and await self.save_items(model, user_id, items, log_fields, False)
+    await self.cache_call(participant_cache.put_answers, user_id, survey_items, chat_items, True)
+    return True
+
+  async def get_chat_answers(self, request, log_fields):
+    user_id = request.args.get('user_id')
+    since = safe_cast(request.args.get('since'), int)
+    log_fields.update(user_id=user_id, since=since)
+
+    if user_id != None:
+      # looked up first on its own connection, it restores an archived participant's answers
+      async with self.engine.connect() as conn:
+        await self.participant(conn, user_id, log_fields)
+    async with self.engine.connect() as conn:
+      result = await conn.execute(sqlalchemy.select(func.max(ChatAnswer.version)).where(ChatAnswer.user_id == user_id))
+      version = result.scalar() or 0
+      log_fields['db_statements'] = log_fields.get('db_statements', 0) + 1
+      pending = answer_buffer.pending_for(ChatAnswer, user_id)
+      etag = chat_answers_etag(version, pending)
+      headers = [(b'etag', ('"%s"' % etag).encode('latin-1')), (b'cache-control', b'no-cache')]
+      if request.etag_matches(etag):
+        return 304, headers, b''
+
+      body = chat_payloads.get(user_id, version) if since == None and len(pending) == 0 else None
+      if body == None:
+        query = sqlalchemy.select(ChatAnswer.question_id, ChatAnswer.answer, ChatAnswer.option_id, ChatAnswer.ts)\
+          .where(ChatAnswer.user_id == user_id)
+        if since != None:
+          query = query.where(ChatAnswer.version > since)
+        result = await conn.execute(query)
+        question_answers = dict((question_id, {"text": answer, "opt_id": option_id, "ts": ts})
+          for question_id, answer, option_id, ts in result)
+        log_fields['db_statements'] += 1
+        body = chat_answers_payload(user_id, question_answers, version, since, pending)
+    return 200, JSON_HEADERS + headers, body
+
+  async def get_survey(self, request, log_fields):
+    survey_file = request.args.get('survey_file')
+    log_fields.update(survey_file=survey_file)
+
+    if survey_file == None:
+      return 200, JSON_HEADERS, json.dumps({'status': 'ERROR', 'message':'Missing arguments'}).encode('utf-8')
+
+    # loaded surveys only cost a stat, a first load or reload runs off the loop
+    if survey_file in survey_registry.surveys:
+      entry = survey_registry.get(survey_file)
+    else:
+      entry = await asyncio.get_running_loop().run_in_executor(None, survey_registry.get, survey_file)
+    if entry == None:
+      logging.warning("Unknown survey file: %s", survey_file)
+      return 200, JSON_HEADERS, json.dumps({'status': 'ERROR', 'message':'Unknown survey'}).encode('utf-8')
+
+    encoding = best_encoding(entry['body'], request.accept_encodings())
+    etag = encoding_etag(entry['etag'], encoding)
+    headers = [
+      (b'etag', ('"%s"' % etag).encode('latin-1')),
+      (b'cache-control', ("public, max-age=%d" % self.flask_app.config['SURVEY_CACHE_MAX_AGE']).encode('latin-1')),
+      (b'vary', b'Accept-Encoding'),
+    ]
+    if request.etag_matches(etag):
+      return 304, headers, b''
+
+    headers.append((b'content-type', b'application/json'))
+    if encoding != 'identity':
+      headers.append((b'content-encoding', encoding.encode('latin-1')))
+    return 200, headers, entry['body'][encoding]
+
+async def read_body(receive):
+  body = b''
+  while True:
+    message = await receive()
+    body += message.get('body', b'')
+    if not message.get('more_body', False):
+      return body
+
+if multiprocessing.parent_process() != None:
+  setup_logging(flask_app, max(serving_processes(), 2))
+  check_participant_cache(max(serving_processes(), 2))
+
+app = StudyASGI(flask_app)
@@ -0,0 +1,349 @@
+import os
+import sys
+import re
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import socket
+import importlib.util
+import urllib.request
+import urllib.parse
+import http.cookiejar
+from concurrent.futures import ThreadPoolExecutor
+
+# Load test of the full participant flow - N concurrent participants go through
+# cookie assignment, survey load, answer saves and all the study pages while a
+# dashboard poller hits /get_study_responses. Runs against the Flask app in
+# process (test client on a scratch SQLite database) or a running server (--url).
+#
+#   python benchmark.py --participants 200 --concurrency 20 --save baseline
+#   python benchmark.py --participants 200 --concurrency 20 --compare baseline
+#
+# --serve starts a real server on a scratch SQLite database first, threaded WSGI
+# (sync) or uvicorn with the async endpoints (asgi), to compare the two paths:
+#
+#   python benchmark.py --serve sync --participants 500 --concurrency 100 --save sync
+#   python benchmark.py --serve asgi --participants 500 --concurrency 100 --compare sync
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASELINE_DIR = os.path.join(ROOT, "benchmark_results")
+
+# Survey pages answered on p3/p4 of the study
+SURVEY_QUESTIONS = ["eng_q%d" % i for i in range(1, 7)] + ["prp_q%d" % i for i in range(1, 7)] + \
+  ["sus_q%d" % i for i in range(1, 12)]
+
+# Route timings, {route: [seconds]}
+timings = {}
+errors = {}
+timings_lock = threading.Lock()
+
+def record(route, elapsed, ok):
+  with timings_lock:
+    timings.setdefault(route, []).append(elapsed)
+    if not ok:
+      errors[route] = errors.get(route, 0) + 1
+
+# Import the app in process, pointed at a scratch database
+def load_app(db_uri, sqlite_path, write_behind):
+  if db_uri != None:
+    os.environ["STUDY_DB_URI"] = db_uri
+  else:
+    os.environ["STUDY_DB_BACKEND"] = "sqlite"
+    os.environ["STUDY_DB_SQLITE_PATH"] = sqlite_path
+  os.environ["STUDY_DB_INIT_ON_START"] = "1"
+  os.environ.setdefault("STUDY_WARM_UP", "eager")
+  os.environ.setdefault("STUDY_LOG_SAMPLE_RATE", "0.01")
+  if write_behind:
+    os.environ["STUDY_ANSWER_WRITE_BEHIND"] = "1"
+
+  spec = importlib.util.spec_from_file_location("study_app", os.path.join(ROOT, "__init__.py"),
+    submodule_search_locations=[ROOT])
+  study_app = importlib.util.module_from_spec(spec)
+  sys.modules["study_app"] = study_app
+  spec.loader.exec_module(study_app)
+  return study_app
+
+class TestClientSession(object):
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def get(self, path):
+    resp = self.client.get(path)
+    return resp.status_code, resp.headers, resp.get_data(as_text=True)
+
+  def post(self, path, data):
+    resp = self.client.post(path, data=data)
+    return resp.status_code, resp.headers, resp.get_data(as_text=True)
+
+class HttpSession(object):
+  def __init__(self, base_url):
+    self.base_url = base_url.rstrip("/")
+    self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+  def get(self, path):
+    return self.open(urllib.request.Request(self.base_url + path))
+
+  def post(self, path, data):
+    return self.open(urllib.request.Request(self.base_url + path, data=urllib.parse.urlencode(data).encode()))
+
+  def open(self, req):
+    try:
+      with self.opener.open(req) as resp:
+        return resp.status, resp.headers, resp.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+      return e.code, e.headers, ""
+
+def timed(route, func, *args):
+  start = time.perf_counter()
+  status, headers, body = func(*args)
+  record(route, time.perf_counter() - start, status in [200, 304])
+  return status, headers, body
+
+# One participant going through the whole study
+def run_participant(session, survey_file):
+  status, headers, body = timed("/", session.get, "/")
+  user_id = re.search(r'var user_id = \( "([^"]*)"', body).group(1)
+  condition_id = re.search(r'var condition_id = \( "([^"]*)"', body).group(1)
+  survey_file = survey_file or condition_id
+
+  status, headers, body = timed("/get_survey", session.get, "/get_survey?" + urllib.parse.urlencode({'survey_file': survey_file}))
+  dialogue = json.loads(body)['survey_data']
+
+  for page_no in range(1, 7):
+    timed("/study_page", session.get, "/study_page?page_no=%d&user_id=%s&condition_id=%s" % (page_no, user_id, condition_id))
+
+    if page_no == 2:
+      # chat conversation, one save per question
+      for item in dialogue:
+        if item['type'] in ['Skip', 'End'] or 'answer' in item:
+          continue
+        if 'options' in item:
+          option = random.choice(item['options'])
+          answer = {'q_ans': option['text'], 'opt_id': option['value']}
+        else:
+          answer = {'q_ans': "write in", 'opt_id': "write in"}
+        query = urllib.parse.urlencode({'user_id': user_id, 'q_id': item['text'], 'source': 'chat'})
+        timed("/save_answer", session.post, "/save_answer?" + query, answer)
+
+    elif page_no == 3 or page_no == 4:
+      for q_id in SURVEY_QUESTIONS:
+        if q_id.startswith("sus_q") == (page_no == 4):
+          query = urllib.parse.urlencode({'user_id': user_id, 'q_id': q_id, 'source': 'survey'})
+          timed("/save_answer", session.post, "/save_answer?" + query, {'q_ans': str(random.randint(1, 5))})
+
+    elif page_no == 5:
+      timed("/get_chat_answers", session.get, "/get_chat_answers?user_id=" + user_id)
+
+def run_dashboard(make_session, interval, stop):
+  session = make_session()
+  while not stop.wait(interval):
+    timed("/get_study_responses", session.get, "/get_study_responses")
+
+def percentile(values, pct):
+  values = sorted(values)
+  idx = max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1)
+  return values[min(idx, len(values) - 1)]
+
+# Mean statements per request, from the app's /metrics histograms
+def statement_counts(study_app):
+  counts = {}
+  with study_app.metrics.lock:
+    for (name, labels), hist in study_app.metrics.histograms.items():
+      if name == "study_request_db_statements" and hist.count > 0:
+        counts[dict(labels)['endpoint']] = round(hist.sum / hist.count, 2)
+  return counts
+
+# Same from a running server's /metrics page
+def scrape_statement_counts(session):
+  status, headers, body = session.get("/metrics")
+  sums = {}
+  totals = {}
+  for line in body.splitlines():
+    match = re.match(r'study_request_db_statements_(sum|count)\{endpoint="([^"]*)"\} (\S+)', line)
+    if match != None:
+      (sums if match.group(1) == 'sum' else totals)[match.group(2)] = float(match.group(3))
+  return dict((endpoint, round(sums.get(endpoint, 0.0) / count, 2)) for endpoint, count in totals.items() if count > 0)
+
+# Serve the app on a scratch database, sync (threaded WSGI) or asgi (uvicorn)
+def run_server(mode, port, sqlite_path, write_behind):
+  study_app = load_app(None, sqlite_path, write_behind)
+  if mode == "asgi":
+    import uvicorn
+    asgi = importlib.import_module("study_app.asgi")
+    uvicorn.run(asgi.app, host="127.0.0.1", port=port, log_level="warning")
+  else:
+    from werkzeug.serving import run_simple
+    run_simple("127.0.0.1", port, study_app.app, threaded=True)
+
+def start_server(mode, sqlite_path, write_behind):
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+
+  command = [sys.executable, os.path.abspath(__file__), "--run-server", mode, "--port", str(port), "--db-path", sqlite_path]
+  if write_behind:
+    command.append("--write-behind")
+  server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+  url = "http://127.0.0.1:%d" % port
+  deadline = time.time() + 60
+  while time.time() < deadline:
+    try:
+      urllib.request.urlopen(url + "/metrics").read()
+      return server, url
+    except (urllib.error.URLError, ConnectionError):
+      if server.poll() != None:
+        break
+      time.sleep(0.2)
+  server.kill()
+  raise RuntimeError("%s server did not come up" % mode)
+
+def git_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode().strip()
+  except Exception:
+    return None
+
+def compare(results, baseline, tolerance):
+  print("\nCompared with baseline from commit %s:" % baseline.get('commit'))
+  regressions = 0
+  for route, stats in sorted(results['routes'].items()):
+    base = baseline['routes'].get(route)
+    if base == None:
+      continue
+    for key in ['p50_ms', 'p95_ms', 'p99_ms']:
+      if base[key] > 0:
+        change = (stats[key] - base[key]) / base[key] * 100.0
+        flag = ""
+        if change > tolerance:
+          flag = "  <-- regression"
+          regressions += 1
+        print("  %-24s %-7s %9.2f -> %9.2f  (%+.1f%%)%s" % (route, key, base[key], stats[key], change, flag))
+
+  for endpoint, count in sorted(results['statements'].items()):
+    base = baseline['statements'].get(endpoint)
+    if base != None and count > base:
+      print("  %-24s statements %.2f -> %.2f  <-- regression" % (endpoint, base, count))
+      regressions += 1
+
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Simulate concurrent study participants")
+  parser.add_argument("--participants", type=int, default=100)
+  parser.add_argument("--concurrency", type=int, default=10)
+  parser.add_argument("--survey", default=None, help="survey file from static/surveys, defaults to the assigned condition")
+  parser.add_argument("--dashboard-interval", type=float, default=2.0, help="seconds between dashboard hits, 0 disables")
+  parser.add_argument("--url", default=None, help="benchmark a running server instead of the in-process app")
+  parser.add_argument("--serve", choices=["sync", "asgi"], default=None,
+    help="start a sync (threaded WSGI) or asgi (uvicorn) server on a scratch SQLite database and benchmark it")
+  parser.add_argument("--run-server", choices=["sync", "asgi"], default=None, help=argparse.SUPPRESS)
+  parser.add_argument("--port", type=int, default=None, help=argparse.SUPPRESS)
+  parser.add_argument("--db-path", default=None, help=argparse.SUPPRESS)
+  parser.add_argument("--db", default=None, help="database URI for the in-process app, defaults to a scratch SQLite (WAL) file")
+  parser.add_argument("--write-behind", action="store_true", help="enable the write-behind answer buffer")
+  parser.add_argument("--save", default=None, help="save results as benchmark_results/<name>.json")
+  parser.add_argument("--compare", default=None, help="compare with benchmark_results/<name>.json")
+  parser.add_argument("--tolerance", type=float, default=20.0, help="allowed latency increase in percent")
+  args = parser.parse_args()
+
+  if args.run_server != None:
+    return run_server(args.run_server, args.port, args.db_path, args.write_behind)
+
+  study_app = None
+  server = None
+  if args.serve != None:
+    sqlite_path = os.path.join(tempfile.mkdtemp(prefix="study_bench_"), "bench.db")
+    print("Database: %s, server: %s" % (sqlite_path, args.serve))
+    server, args.url = start_server(args.serve, sqlite_path, args.write_behind)
+
+  if args.url != None:
+    make_session = lambda: HttpSession(args.url)
+  else:
+    sqlite_path = os.path.join(tempfile.mkdtemp(prefix="study_bench_"), "bench.db")
+    print("Database: %s" % (args.db or sqlite_path))
+    study_app = load_app(args.db, sqlite_path, args.write_behind)
+    app = study_app.app
+    make_session = lambda: TestClientSession(app)
+
+  stop = threading.Event()
+  dashboard = None
+  if args.dashboard_interval > 0:
+    dashboard = threading.Thread(target=run_dashboard, args=(make_session, args.dashboard_interval, stop), daemon=True)
+    dashboard.start()
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+    futures = [pool.submit(run_participant, make_session(), args.survey) for p in range(args.participants)]
+    failed = 0
+    for future in futures:
+      try:
+        future.result()
+      except Exception as e:
+        failed += 1
+        print("Participant failed: %r" % e)
+  elapsed = time.perf_counter() - start
+  stop.set()
+  if dashboard != None:
+    dashboard.join()
+
+  statements = {}
+  if study_app != None:
+    statements = statement_counts(study_app)
+  elif args.url != None:
+    statements = scrape_statement_counts(HttpSession(args.url))
+  if server != None:
+    server.terminate()
+    server.wait()
+
+  total_requests = sum(len(values) for values in timings.values())
+  results = {
+    'commit': git_commit(),
+    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    'participants': args.participants,
+    'concurrency': args.concurrency,
+    'failed_participants': failed,
+    'elapsed_s': round(elapsed, 3),
+    'throughput_rps': round(total_requests / elapsed, 2),
+    'routes': {},
+    'serve': args.serve,
+    'statements': statements,
+  }
+  for route, values in timings.items():
+    results['routes'][route] = {
+      'requests': len(values),
+      'errors': errors.get(route, 0),
+      'p50_ms': round(percentile(values, 50) * 1000.0, 2),
+      'p95_ms': round(percentile(values, 95) * 1000.0, 2),
+      'p99_ms': round(percentile(values, 99) * 1000.0, 2),
+    }
+
+  print("\n%d participants, %d concurrent, %d requests in %.2fs - %.1f req/s, %d failed participants" % (
+    args.participants, args.concurrency, total_requests, elapsed, results['throughput_rps'], failed))
+  print("  %-24s %8s %7s %9s %9s %9s %10s" % ("route", "requests", "errors", "p50 ms", "p95 ms", "p99 ms", "statements"))
+  endpoints = {"/": "study_main"}
+  for route, stats in sorted(results['routes'].items()):
+    statements = results['statements'].get(endpoints.get(route, route.strip("/")), '')
+    print("  %-24s %8d %7d %9.2f %9.2f %9.2f %10s" % (route, stats['requests'], stats['errors'],
+      stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], statements))
+
+  regressions = 0
+  if args.compare != None:
+    with open(os.path.join(BASELINE_DIR, args.compare + ".json")) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+
+  if args.save != None:
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(os.path.join(BASELINE_DIR, args.save + ".json"), "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    print("\nSaved results to benchmark_results/%s.json" % args.save)
+
+  if regressions > 0 or failed > 0:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
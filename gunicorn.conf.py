@@ -0,0 +1,36 @@
+# Several worker processes with gunicorn:
+#
+#   gunicorn -c <package dir>/gunicorn.conf.py
+#
+# The app is created once in the master (preload_app) with an eager warm-up, so the
+# survey registry and the compiled templates are shared by the forked workers.
+# Workers get their own connections and threads in post_fork (see after_fork()).
+# Set STUDY_PARTICIPANT_CACHE_URL=redis://... so the workers share the participant
+# cache, without it each worker reads participants from the database.
+# Logs: every worker appends to logs/app.log and none of them rotates it, rotate
+# it with logrotate (the workers reopen the moved file), or set STUDY_LOG_FILE=0
+# and collect stdout. /metrics reports the worker that answers.
+import os
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE = os.path.basename(PACKAGE_DIR)
+
+chdir = os.path.dirname(PACKAGE_DIR)
+wsgi_app = "%s:app" % PACKAGE
+bind = os.environ.get("STUDY_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("STUDY_WORKERS", "4"))
+threads = int(os.environ.get("STUDY_THREADS", "8"))
+preload_app = True
+
+os.environ.setdefault("STUDY_WARM_UP", "eager")
+# the preloaded app already sets up logging and caches for several workers
+os.environ.setdefault("STUDY_WORKERS", str(workers))
+
+def post_fork(server, worker):
+  study_app = sys.modules[PACKAGE]
+  study_app.after_fork(study_app.app, workers)
+
+def worker_exit(server, worker):
+  study_app = sys.modules[PACKAGE]
+  study_app.before_worker_exit()
@@ -0,0 +1,164 @@
+# Upgrade of a database with the original schema and US/Pacific datetimes, with
+# the old workers still writing between 'flask migrate' and 'flask migrate --contract'
+#
+#   python -m pytest test_upgrade.py
+import os
+import sys
+import json
+import sqlite3
+import importlib.util
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import sqlalchemy
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+BASELINE_SCHEMA = """
+create table user_entry (user_id varchar(64) primary key, condition varchar(64), timestamp datetime);
+create table user_answer (answer_id integer primary key, question_id varchar(64) not null, answer varchar(10000) not null,
+  timestamp datetime, user_id varchar(64) references user_entry(user_id));
+create table chat_answer (answer_id integer primary key, question_id varchar(1024) not null, answer varchar(10000) not null,
+  option_id varchar(1024) not null, timestamp datetime, user_id varchar(64) references user_entry(user_id));
+insert into user_entry values ('u1', '_big_5_conv.json', '2024-03-01 10:00:00.000000');
+insert into user_answer values (1, 'page', '1', '2024-03-01 10:00:01.000000', 'u1');
+insert into user_answer values (2, 'complete', 'false', '2024-03-01 10:00:01.000000', 'u1');
+insert into user_answer values (3, 'page', '6', '2024-03-01 10:20:00.000000', 'u1');
+insert into user_answer values (4, 'sus_q1', '3', '2024-03-01 10:25:00.000000', 'u1');
+insert into user_answer values (5, 'sus_q1', '4', '2024-03-01 10:26:00.000000', 'u1');
+insert into user_answer values (6, 'complete', 'true', '2024-03-01 10:30:00.000000', 'u1');
+insert into chat_answer values (1, 'Q one?', 'Yes', '1', '2024-03-01 10:28:00.000000', 'u1');
+insert into user_entry values ('u2', '_fitness_survey_conv.json', '2024-07-02 09:00:00.000000');
+insert into user_answer values (7, 'page', '3', '2024-07-02 09:00:05.000000', 'u2');
+insert into chat_answer values (2, 'Q one?', 'No', '2', '2024-07-02 09:40:00.000000', 'u2');
+insert into chat_answer values (3, 'Q one?', 'Yes', '1', '2024-07-02 09:41:00.000000', 'u2');
+"""
+
+# What the old code does next to the expand migrations: Pacific datetimes, no ts,
+# a second 'page' answer and a new participant
+OLD_WORKER_WRITES = """
+insert into user_answer (question_id, answer, timestamp, user_id) values ('page', '7', '2024-03-01 10:40:00.000000', 'u1');
+insert into user_entry (user_id, condition, timestamp) values ('u3', '_big_5_conv.json', '2024-07-03 12:00:00.000000');
+insert into user_answer (question_id, answer, timestamp, user_id) values ('page', '1', '2024-07-03 12:00:01.000000', 'u3');
+"""
+
+@pytest.fixture
+def study(tmp_path, monkeypatch):
+  db_path = str(tmp_path / "study.db")
+  conn = sqlite3.connect(db_path)
+  conn.executescript(BASELINE_SCHEMA)
+  conn.commit()
+  conn.close()
+
+  for name, value in [("DB_URI", "sqlite:///" + db_path), ("DB_INIT_ON_START", "1"), ("WARM_UP", "off"), ("LOG_FILE", "0")]:
+    monkeypatch.setenv("STUDY_" + name, value)
+  spec = importlib.util.spec_from_file_location("study_upgrade", os.path.join(ROOT, "__init__.py"),
+    submodule_search_locations=[ROOT])
+  study_app = importlib.util.module_from_spec(spec)
+  monkeypatch.setitem(sys.modules, "study_upgrade", study_app)
+  spec.loader.exec_module(study_app)
+  app = study_app.create_app()
+  yield study_app, app, db_path
+  with app.app_context():
+    study_app.db.engine.dispose()
+
+def unique_indexes(study_app, table):
+  return [index['name'] for index in sqlalchemy.inspect(study_app.db.engine).get_indexes(table) if index['unique']]
+
+def test_upgrade_with_old_workers(study):
+  study_app, app, db_path = study
+  db = study_app.db
+
+  with app.app_context():
+    study_app.run_migrations(batch_size=2)
+    assert study_app.pending_migrations() == sorted(study_app.CONTRACT_MIGRATIONS)
+    assert unique_indexes(study_app, "user_answer") == []
+
+  conn = sqlite3.connect(db_path)
+  conn.executescript(OLD_WORKER_WRITES)
+  conn.commit()
+  conn.close()
+
+  # the new code writes UTC next to them, without the unique indexes
+  client = app.test_client()
+  before = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=5)
+  for answer in ["2", "5"]:
+    resp = client.post("/save_answer?user_id=u2&q_id=sus_q1&source=survey", data={'q_ans': answer})
+    assert json.loads(resp.data)['status'] == "OK"
+  resp = client.post("/save_answer?user_id=u2&q_id=Q one?&source=chat", data={'q_ans': 'Maybe', 'opt_id': '3'})
+  assert json.loads(resp.data)['status'] == "OK"
+
+  with app.app_context():
+    assert study_app.UserAnswer.query.filter_by(user_id="u2", question_id="sus_q1").count() == 1
+    study_app.run_migrations(batch_size=2, contract=True)
+    assert study_app.pending_migrations() == []
+    assert unique_indexes(study_app, "user_answer") == ["uq_user_answer_user_question"]
+
+    answers = dict(((a.user_id, a.question_id), a) for a in study_app.UserAnswer.query)
+    assert len(answers) == study_app.UserAnswer.query.count()
+    # March is PST (UTC-8), July PDT (UTC-7)
+    assert answers[("u1", "page")].answer == "7"
+    assert answers[("u1", "page")].timestamp == datetime(2024, 3, 1, 18, 40)
+    assert answers[("u1", "sus_q1")].timestamp == datetime(2024, 3, 1, 18, 26)
+    assert answers[("u3", "page")].timestamp == datetime(2024, 7, 3, 19, 0, 1)
+    assert answers[("u2", "sus_q1")].answer == "5"
+    assert answers[("u2", "sus_q1")].timestamp >= before
+    for answer in answers.values():
+      assert study_app.utc_from_ms(answer.ts) == answer.timestamp
+
+    chat = dict((a.user_id, a) for a in study_app.ChatAnswer.query)
+    assert study_app.ChatAnswer.query.count() == 2
+    assert chat["u1"].timestamp == datetime(2024, 3, 1, 18, 28)
+    assert chat["u2"].answer == "Maybe" and chat["u2"].timestamp >= before
+
+    entries = dict((e.user_id, e) for e in study_app.UserEntry.query)
+    assert all(entry.timestamp_tz == "UTC" for entry in entries.values())
+    assert entries["u1"].timestamp == datetime(2024, 3, 1, 18, 0)
+    assert entries["u1"].current_page == 7
+    # completed before the upgrade, 0001 set it from the answers back then
+    assert entries["u1"].completed_at == datetime(2024, 3, 1, 18, 30)
+    assert entries["u1"].last_activity_at == datetime(2024, 3, 1, 18, 40)
+    assert entries["u2"].timestamp == datetime(2024, 7, 2, 16, 0)
+    assert entries["u2"].last_activity_at >= before
+    assert entries["u2"].completed_at == None
+    assert entries["u3"].timestamp == datetime(2024, 7, 3, 19, 0)
+
+    # keyset pages over the (timestamp, user_id) index
+    assert "ix_user_entry_timestamp_user" in [index['name'] for index in sqlalchemy.inspect(db.engine).get_indexes("user_entry")]
+    first = study_app.get_entries_page(limit=2)
+    rest = study_app.get_entries_page((first[-1].timestamp, first[-1].user_id), limit=2)
+    assert [entry.user_id for entry in first + rest] == ["u3", "u2", "u1"]
+    # shown in US/Pacific
+    rows = dict((row['user_id'], row) for row in study_app.get_study_rows(first + rest))
+    assert rows["u1"]['datetime'].isoformat() == "2024-03-01T10:00:00-08:00"
+
+    # the workers pick up the unique indexes and go back to the upserts
+    study_app.answer_upserts.checked_at = None
+    assert study_app.answer_upserts.check()
+
+  resp = client.post("/save_answer?user_id=u3&q_id=sus_q1&source=survey", data={'q_ans': '1'})
+  assert json.loads(resp.data)['status'] == "OK"
+  with app.app_context():
+    assert study_app.UserAnswer.query.filter_by(user_id="u3").count() == 2
+
+def test_save_answers_checks_each_item(study):
+  study_app, app, db_path = study
+  with app.app_context():
+    study_app.run_migrations(batch_size=2, contract=True)
+
+  client = app.test_client()
+  resp = client.post("/save_answers?user_id=u2", json=[
+    {'q_id': 5, 'q_ans': {'x': 1}},
+    {'q_id': 'x' * 65, 'q_ans': '1'},
+    {'q_id': 'sus_q2', 'q_ans': 4},
+    {'q_id': 'sus_q3', 'q_ans': True},
+    {'source': 'chat', 'q_id': 'Q two?', 'q_ans': 'Yes', 'opt_id': ['1']},
+    {'source': 'chat', 'q_id': 'x' * 65, 'q_ans': 'No', 'opt_id': 2}])
+  results = json.loads(resp.data)['results']
+  assert [result['status'] for result in results] == ["ERROR", "ERROR", "OK", "OK", "ERROR", "OK"]
+
+  with app.app_context():
+    answers = dict((a.question_id, a.answer) for a in study_app.UserAnswer.query.filter_by(user_id="u2"))
+    assert answers["sus_q2"] == "4" and answers["sus_q3"] == "true"
+    chat = study_app.ChatAnswer.query.filter_by(user_id="u2", question_id="x" * 65).one()
+    assert chat.option_id == "2"